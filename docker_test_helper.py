@@ -10,10 +10,13 @@ without requiring actual hardware.
 import os
 import sys
 import tempfile
+import selectors
 import socket
+import stat
 import struct
 import threading
 import time
+import functools
 import unittest
 import logging
 from unittest import mock
@@ -31,6 +34,62 @@ HID_DEVICE_PATH = '/dev/hidg0'
 USB_PACKET_SIZE = 64
 MOCK_HID_PATH = None
 
+# USB/IP operation and command codes; OP requests start with the protocol
+# version in the high half of their first word and the OP code in the low
+# half, while USB commands start with a 32 bit command code
+USBIP_VERSION = 0x0111
+OP_REQ_DEVLIST = 0x8005
+OP_REQ_IMPORT = 0x8003
+USBIP_CMD_SUBMIT = 0x00000001
+USBIP_CMD_UNLINK = 0x00000002
+USBIP_RET_SUBMIT = 0x00000003
+USBIP_RET_UNLINK = 0x00000004
+USBIP_DIR_OUT = 0x00
+
+# Request sizes: OP requests are an 8 byte header, followed by a 32 byte bus
+# ID for imports; USB commands are a 48 byte header, followed by the transfer
+# buffer for OUT submits
+_OP_REQ_LEN = {OP_REQ_DEVLIST: 8, OP_REQ_IMPORT: 40}
+_CMD_LEN = 48
+
+# Initial size of each client's receive buffer
+_RECV_BUF_SIZE = 4096
+
+# How long cleanup() waits for the server loop to stop, in seconds
+_LOOP_JOIN_TIMEOUT = 5.0
+
+# Precompiled USB/IP wire formats
+_HDR = struct.Struct("!II")
+_DEVLIST_HDR = struct.Struct("!HHI")
+_NUM_DEVICES = struct.Struct("!I")
+_DEV_SUMMARY = struct.Struct("!256s32sIIIHHHBBBBBB")  # As in usbip/usbip.go
+_DEV_INTERFACE = struct.Struct("!BBx")  # Class, subclass, padding
+_RETURN_RESP = struct.Struct("!IIIIII")
+_SUBMIT_TRANSFER = struct.Struct("!I8xI")  # Direction, transfer buffer length
+
+# Bound C implementations used directly by the per-request code
+_parse_header = _HDR.unpack_from
+_parse_submit_transfer = _SUBMIT_TRANSFER.unpack_from
+_pack_return = _RETURN_RESP.pack_into
+
+# The device list and import responses never vary, so build them once
+_DEVICE_SUMMARY = _DEV_SUMMARY.pack(
+    b"", b"2-2",  # Path, bus ID
+    2, 2, 2,  # Bus number, device number, speed
+    0x18d1, 0x5022, 0x0200,  # VendorID, ProductID, bcdDevice
+    0, 0, 0, 1, 1, 1  # Class, subclass, protocol, configuration, counts
+)
+_DEVLIST_RESPONSE = (
+    _DEVLIST_HDR.pack(0x0111, 0x0001, 0)  # Version, reply code, status
+    + _NUM_DEVICES.pack(1)  # Number of devices
+    + _DEVICE_SUMMARY
+    + _DEV_INTERFACE.pack(3, 0)  # HID interface
+)
+_IMPORT_RESPONSE = (
+    _DEVLIST_HDR.pack(0x0111, 0x0003, 0)  # Version, reply code, status
+    + _DEVICE_SUMMARY
+)
+
 class MockUSBIPServer:
     """Mock USB/IP server for testing"""
     
@@ -38,164 +97,295 @@ class MockUSBIPServer:
         self.host = host
         self.port = port
         self.server_socket = None
-        self.client_socket = None
-        self.running = False
+        self.clients = {}  # Client socket -> [receive buffer, bytes held]
         self.thread = None
+        # cleanup() runs from both the caller and the server loop's exit
+        # path; only the first call does anything
+        self._cleanup_lock = threading.Lock()
+        self._cleaned_up = False
+        self._selector = None
+        self._unix_path = None
+        self._wakeup_recv = None
+        self._wakeup_send = None
+        self._replies = []
+        self._return_buf = bytearray(_RETURN_RESP.size * 64)
+        self._return_view = memoryview(self._return_buf)
+        self._return_used = 0
+        
+        # Request handlers keyed by OP request code and USB command; submit
+        # and unlink go straight to _send_return() with their reply code
+        self._op_handlers = {
+            OP_REQ_DEVLIST: self._send_device_list,
+            OP_REQ_IMPORT: self._send_device_import,
+        }
+        self._cmd_handlers = {
+            USBIP_CMD_SUBMIT: functools.partial(self._send_return, USBIP_RET_SUBMIT),
+            USBIP_CMD_UNLINK: functools.partial(self._send_return, USBIP_RET_UNLINK),
+        }
     
     def start(self):
         """Start the mock server"""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Set socket option to reuse address
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.host.startswith("/"):
+            # A path means a Unix socket, which skips the TCP/IP stack for
+            # clients on the same host
+            self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Set socket options to reuse address (and port, where supported)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(1)
-            logger.info(f"Mock USB/IP server listening on {self.host}:{self.port}")
+            if self.server_socket.family == socket.AF_INET:
+                self.server_socket.bind((self.host, self.port))
+                # Port 0 asks the OS for a free port; record the one we got
+                self.port = self.server_socket.getsockname()[1]
+            else:
+                # A socket file left by a crashed run would make bind fail;
+                # anything else at the path is not ours to remove
+                try:
+                    if stat.S_ISSOCK(os.stat(self.host).st_mode):
+                        os.unlink(self.host)
+                except FileNotFoundError:
+                    pass
+                self.server_socket.bind(self.host)
+                self._unix_path = self.host
+            # One loop serves every client, so let them all queue up
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.server_socket.setblocking(False)
+            if self._unix_path:
+                logger.info("Mock USB/IP server listening on %s", self._unix_path)
+            else:
+                logger.info("Mock USB/IP server listening on %s:%s", self.host, self.port)
+            
+            # The server loop waits on the listening socket, every client and
+            # a wakeup socket that cleanup() writes to when shutting down
+            self._wakeup_recv, self._wakeup_send = socket.socketpair()
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self.server_socket, selectors.EVENT_READ, self._accept_client)
+            self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
             
-            self.running = True
             self.thread = threading.Thread(target=self._server_loop)
             self.thread.daemon = True
             self.thread.start()
             
             return True
         except Exception as e:
-            logger.error(f"Failed to start mock USB/IP server: {e}")
+            logger.error("Failed to start mock USB/IP server: %s", e)
             self.cleanup()
+            self._close_selector()
             return False
     
     def _server_loop(self):
         """Main server loop"""
         try:
-            while self.running:
-                # Set a timeout for accept to allow checking running state
-                self.server_socket.settimeout(1.0)
-                try:
-                    client, addr = self.server_socket.accept()
-                    logger.info(f"Client connected from {addr}")
-                    self.client_socket = client
-                    self._handle_client(client)
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    logger.error(f"Error accepting connection: {e}")
-                    if self.client_socket:
-                        self.client_socket.close()
-                        self.client_socket = None
+            # Runs until cleanup() writes to the wakeup socket
+            while True:
+                for key, _ in self._selector.select():
+                    # Only the wakeup socket is registered without a handler
+                    if key.data is None:
+                        return
+                    key.data(key.fileobj)
         except Exception as e:
-            logger.error(f"Server loop error: {e}")
+            logger.error("Server loop error: %s", e)
         finally:
             self.cleanup()
+            self._close_selector()
+    
+    def _accept_client(self, server_socket):
+        """Accept a new client connection"""
+        try:
+            client, addr = server_socket.accept()
+        except BlockingIOError:
+            # The connection was reset between the selector reporting it and
+            # the accept; the listening socket is non-blocking, so this
+            # returns straight away instead of stalling the loop
+            return
+        except Exception as e:
+            logger.error("Error accepting connection: %s", e)
+            return
+        
+        try:
+            logger.info("Client connected from %s", addr or self.host)
+            # Replies are small, so send them immediately instead of
+            # letting Nagle's algorithm hold them back
+            if client.family == socket.AF_INET:
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+            self.clients[client] = [bytearray(_RECV_BUF_SIZE), 0]
+            self._selector.register(client, selectors.EVENT_READ, self._handle_client)
+        except Exception as e:
+            logger.error("Error setting up client connection: %s", e)
+            self._close_client(client)
     
     def _handle_client(self, client):
-        """Handle client connection"""
+        """Handle data from a connected client"""
+        state = self.clients[client]
+        buf, end = state
         try:
-            while self.running:
-                # Receive data with timeout
-                client.settimeout(1.0)
-                try:
-                    data = client.recv(1024)
-                    if not data:
-                        logger.info("Client disconnected")
-                        break
+            if end == len(buf):
+                # The held bytes are the start of a frame bigger than the
+                # buffer (a large OUT transfer), so make room for the rest
+                buf.extend(bytes(len(buf)))
+            
+            with memoryview(buf) as view:
+                # Read straight into the client's buffer after the bytes
+                # still held from the last read
+                received = client.recv_into(view[end:])
+                if not received:
+                    logger.info("Client disconnected")
+                    self._close_client(client)
+                    return
+                end += received
+                
+                # Handle every complete request in the buffer before reading
+                # again, then move any partial request to the front
+                offset = 0
+                get_op_handler = self._op_handlers.get
+                get_cmd_handler = self._cmd_handlers.get
+                while end - offset >= _HDR.size:
+                    cmd, seq_num = _parse_header(view, offset)
+                    
+                    # Handle device list and import requests
+                    if cmd >> 16 == USBIP_VERSION:
+                        op_code = cmd & 0xFFFF
+                        op_handler = get_op_handler(op_code)
+                        if not op_handler:
+                            logger.warning("Dropping %d bytes after unknown OP request: 0x%04x", end - offset, op_code)
+                            offset = end
+                            break
+                        
+                        length = _OP_REQ_LEN[op_code]
+                        if end - offset < length:
+                            break
+                        op_handler(client)
                     
-                    # Parse command header
-                    if len(data) >= 8:
-                        # Handle device list request
-                        if data[4:8] == b'\x00\x00\x00\x01':  # OP_REQ_DEVLIST
-                            logger.info("Received device list request")
-                            self._send_device_list(client)
+                    # Handle USB commands
+                    else:
+                        cmd_handler = get_cmd_handler(cmd)
+                        if not cmd_handler:
+                            logger.warning("Dropping %d bytes after unknown USB command: %d", end - offset, cmd)
+                            offset = end
+                            break
                         
-                        # Handle device import request
-                        elif data[4:8] == b'\x00\x00\x00\x03':  # OP_REQ_IMPORT
-                            logger.info("Received device import request")
-                            self._send_device_import(client)
+                        length = _CMD_LEN
+                        if cmd == USBIP_CMD_SUBMIT and end - offset >= length:
+                            # OUT transfers are followed by their transfer buffer
+                            direction, transfer_length = _parse_submit_transfer(view, offset + 12)
+                            if direction == USBIP_DIR_OUT:
+                                length += transfer_length
+                        if end - offset < length:
+                            break
                         
-                        # Handle USB commands
-                        elif len(data) >= 4:
-                            cmd = struct.unpack("!I", data[0:4])[0]
-                            logger.info(f"Received USB command: {cmd}")
-                            
-                            # SUBMIT command
-                            if cmd == 0x00000001:
-                                seq_num = struct.unpack("!I", data[4:8])[0]
-                                self._send_submit_response(client, seq_num)
-                            
-                            # UNLINK command
-                            elif cmd == 0x00000002:
-                                seq_num = struct.unpack("!I", data[4:8])[0]
-                                self._send_unlink_response(client, seq_num)
+                        logger.debug("Received USB command: %d", cmd)
+                        cmd_handler(client, seq_num)
                     
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    logger.error(f"Error handling client data: {e}")
-                    break
+                    offset += length
+                
+                if offset and offset < end:
+                    view[:end - offset] = view[offset:end]
+                state[1] = end - offset
+            
+            self._flush(client)
+        
         except Exception as e:
-            logger.error(f"Client handler error: {e}")
+            logger.error("Error handling client data: %s", e)
+            self._discard_replies()
+            self._close_client(client)
+    
+    def _close_client(self, client):
+        """Stop watching a client and close its socket"""
+        try:
+            self._selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        self.clients.pop(client, None)
+        client.close()
+    
+    def _send(self, client, data):
+        """Queue a reply; everything queued for one recv is sent by _flush()"""
+        self._replies.append(data)
+    
+    def _flush(self, client):
+        """Send all queued replies with a single gathering write"""
+        replies = self._replies
+        if not replies:
+            return
+        
+        try:
+            sent = client.sendmsg(replies)
+            total = sum(map(len, replies))
+            if sent < total:
+                client.sendall(b"".join(replies)[sent:])
         finally:
-            if client:
-                client.close()
+            self._discard_replies()
+    
+    def _discard_replies(self):
+        """Forget queued replies and free their return buffer slots"""
+        self._replies.clear()
+        self._return_used = 0
     
     def _send_device_list(self, client):
         """Send a mock device list response"""
-        # Version, reply code, status
-        response = struct.pack("!HHI", 0x0111, 0x0001, 0)
-        # Number of devices
-        response += struct.pack("!I", 1)
-        
-        # Device information (simplified)
-        dev_info = b"2-2\0" + b"\0" * 28  # Bus ID
-        dev_info += struct.pack("!IIIIIHHHBB", 
-            2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1
-        )
-        response += dev_info
-        
-        client.sendall(response)
+        logger.debug("Received device list request")
+        self._send(client, _DEVLIST_RESPONSE)
     
     def _send_device_import(self, client):
         """Send a mock device import response"""
-        # Version, reply code, status
-        response = struct.pack("!HHI", 0x0111, 0x0003, 0)
-        
-        # Basic device info
-        dev_info = struct.pack("!II", 0x18d1, 0x5022)  # VendorID, ProductID
-        response += dev_info + b"\0" * 500  # Padding
-        
-        client.sendall(response)
-    
-    def _send_submit_response(self, client, seq_num):
-        """Send a mock submit response"""
-        response = struct.pack("!IIIIII",
-            0x00000003,  # Reply to SUBMIT
-            seq_num,
-            0,  # Status
-            0,  # Actual length
-            0,  # Start frame
-            0   # Error count
-        )
-        client.sendall(response)
+        logger.debug("Received device import request")
+        self._send(client, _IMPORT_RESPONSE)
     
-    def _send_unlink_response(self, client, seq_num):
-        """Send a mock unlink response"""
-        response = struct.pack("!IIIIII",
-            0x00000004,  # Reply to UNLINK
-            seq_num,
-            0,  # Status
-            0, 0, 0  # Padding
-        )
-        client.sendall(response)
+    def _send_return(self, command, client, seq_num):
+        """Send a submit/unlink reply with zero status and padding"""
+        # Replies are packed into the next free slot of a preallocated
+        # buffer; slots are reused once the queued replies are flushed
+        buf = self._return_buf
+        offset = self._return_used
+        if offset == len(buf):
+            self._flush(client)
+            offset = 0
+        
+        end = offset + _RETURN_RESP.size
+        _pack_return(buf, offset, command, seq_num, 0, 0, 0, 0)
+        self._return_used = end
+        self._replies.append(self._return_view[offset:end])
     
     def cleanup(self):
         """Clean up resources"""
-        self.running = False
+        with self._cleanup_lock:
+            if self._cleaned_up:
+                return
+            self._cleaned_up = True
+        
+        # Wake the server loop so it exits
+        wakeup = self._wakeup_send
+        if wakeup:
+            try:
+                wakeup.send(b"\0")
+            except OSError:
+                pass
         
-        if self.client_socket:
+        # Wait for the loop to stop before touching the clients it manages;
+        # when the loop itself is cleaning up it has already stopped
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(_LOOP_JOIN_TIMEOUT)
+            if self.thread.is_alive():
+                # Most likely stuck sending to a client that isn't reading;
+                # shutting the clients down below makes that send fail
+                logger.warning("Mock USB/IP server loop still running after %.0f seconds", _LOOP_JOIN_TIMEOUT)
+        
+        # Shut clients down so their peers see the disconnect right away
+        for client in list(self.clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
-                self.client_socket.close()
+                client.close()
             except:
                 pass
-            self.client_socket = None
+        self.clients.clear()
         
         if self.server_socket:
             try:
@@ -204,7 +394,25 @@ class MockUSBIPServer:
                 pass
             self.server_socket = None
         
+        if self._unix_path:
+            try:
+                os.unlink(self._unix_path)
+            except OSError:
+                pass
+            self._unix_path = None
+        
         logger.info("Mock USB/IP server cleaned up")
+    
+    def _close_selector(self):
+        """Release the selector and wakeup sockets once the loop has exited"""
+        if self._selector:
+            self._selector.close()
+            self._selector = None
+        
+        for sock in (self._wakeup_recv, self._wakeup_send):
+            if sock:
+                sock.close()
+        self._wakeup_recv = self._wakeup_send = None
 
 
 def create_mock_hid_device():
@@ -212,11 +420,10 @@ def create_mock_hid_device():
     global MOCK_HID_PATH
     
     # Create a temporary file to use as the mock HID device
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
-    MOCK_HID_PATH = temp_file.name
-    temp_file.close()
+    fd, MOCK_HID_PATH = tempfile.mkstemp()
+    os.close(fd)
     
-    logger.info(f"Created mock HID device at {MOCK_HID_PATH}")
+    logger.info("Created mock HID device at %s", MOCK_HID_PATH)
     return MOCK_HID_PATH
 
 
@@ -227,9 +434,9 @@ def cleanup_mock_hid_device():
     if MOCK_HID_PATH and os.path.exists(MOCK_HID_PATH):
         try:
             os.unlink(MOCK_HID_PATH)
-            logger.info(f"Removed mock HID device at {MOCK_HID_PATH}")
+            logger.info("Removed mock HID device at %s", MOCK_HID_PATH)
         except Exception as e:
-            logger.error(f"Failed to remove mock HID device: {e}")
+            logger.error("Failed to remove mock HID device: %s", e)
         
         MOCK_HID_PATH = None
 
@@ -240,7 +447,14 @@ def mock_open_device():
     mock_path = create_mock_hid_device()
     
     # Start mock USB/IP server
-    server = MockUSBIPServer()
+    # Prefer a per-process Unix socket since the shim runs on the same
+    # host; otherwise use a free TCP port so parallel runs don't fight
+    # over USBIP_PORT
+    if hasattr(socket, "AF_UNIX"):
+        socket_path = os.path.join(tempfile.gettempdir(), f"mock_usbip_{os.getpid()}.sock")
+        server = MockUSBIPServer(host=socket_path)
+    else:
+        server = MockUSBIPServer(port=0)
     if not server.start():
         cleanup_mock_hid_device()
         return None, None
@@ -263,7 +477,7 @@ def run_tests():
     
     try:
         # Create a shim using the mock device
-        shim = USBIPShim("127.0.0.1", USBIP_PORT, mock_path)
+        shim = USBIPShim(server.host, server.port, mock_path)
         
         # Connect
         connected = shim.connect()
@@ -289,7 +503,7 @@ def run_tests():
         return True
         
     except Exception as e:
-        logger.error(f"Test error: {e}")
+        logger.error("Test error: %s", e)
         return False
     finally:
         # Clean up
@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the USB/IP to USB Gadget Shim
+
+Run with:
+  python3 usbip_to_gadget.py --unittest
+"""
+
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import usbip_to_gadget
+from docker_test_helper import MockUSBIPServer
+from usbip_to_gadget import (
+    USBIPShim,
+    USBIP_PORT,
+    USB_PACKET_SIZE,
+    USBIP_CMD_SUBMIT,
+    USBIP_CMD_UNLINK,
+    USBIP_DIR_OUT,
+    USBIP_DIR_IN,
+    USB_ENDPOINT_OUT,
+    USB_ENDPOINT_IN,
+    _SUBMIT_REPLY,
+    _U32,
+    _HHI,
+    _DEVICE_SUMMARY,
+    _DEVICE_INTERFACE,
+    _USAGE,
+    _build_parser,
+)
+
+
+class TestUSBIPShim(unittest.TestCase):
+    """Test cases for the USB/IP Shim"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        # Create a temporary file to mock the HID device
+        self.temp_file = tempfile.NamedTemporaryFile(delete=False)
+        self.temp_filename = self.temp_file.name
+        self.temp_file.close()
+        
+        # Create mocked socket, handed to the shim through its socket factory
+        self.mock_socket = mock.MagicMock()
+        self.socket_factory = mock.MagicMock(return_value=self.mock_socket)
+        
+        # Set up the shim with our test file as the HID device
+        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename,
+                              socket_factory=self.socket_factory)
+    
+    def tearDown(self):
+        """Clean up after tests"""
+        # Remove temporary file
+        if os.path.exists(self.temp_filename):
+            os.unlink(self.temp_filename)
+    
+    def test_connect(self):
+        """Test connection setup"""
+        # Prepare mocks
+        self.mock_socket.connect = mock.MagicMock()
+        
+        # Call the method
+        result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        self.assertTrue(self.shim.connected)
+        self.mock_socket.connect.assert_called_once_with(("127.0.0.1", 3240))
+        self.mock_socket.setsockopt.assert_any_call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def test_connect_with_nagle(self):
+        """Test that TCP_NODELAY is left unset when Nagle is requested"""
+        # Set up the shim with Nagle's algorithm left on
+        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename,
+                              socket_factory=self.socket_factory, tcp_nodelay=False)
+        
+        # Call the method
+        result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        self.assertNotIn(mock.call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                         self.mock_socket.setsockopt.call_args_list)
+    
+    def test_connect_unix_socket(self):
+        """Test connecting to a USB/IP server on a Unix socket"""
+        # Set up the shim with a socket path as the host
+        self.shim = USBIPShim("/tmp/usbip.sock", 3240, self.temp_filename,
+                              socket_factory=self.socket_factory)
+        
+        # Call the method
+        result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        self.socket_factory.assert_called_once_with(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.mock_socket.connect.assert_called_once_with("/tmp/usbip.sock")
+    
+    def test_connect_unix_socket_fallback(self):
+        """Test falling back to TCP when no server listens on the Unix socket"""
+        # The first socket is for the Unix socket, which nothing listens on
+        unix_socket = mock.MagicMock()
+        unix_socket.connect.side_effect = FileNotFoundError
+        self.socket_factory.side_effect = [unix_socket, self.mock_socket]
+        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename,
+                              socket_factory=self.socket_factory,
+                              unix_socket="/tmp/usbipd.sock")
+        
+        # Call the method
+        result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        unix_socket.connect.assert_called_once_with("/tmp/usbipd.sock")
+        unix_socket.close.assert_called_once()
+        self.assertIs(self.shim.sock, self.mock_socket)
+        self.mock_socket.connect.assert_called_once_with(("127.0.0.1", 3240))
+    
+    def test_connect_unix_socket_unsupported(self):
+        """Test falling back to TCP on platforms without Unix sockets"""
+        # Setup
+        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename,
+                              socket_factory=self.socket_factory,
+                              unix_socket="/tmp/usbipd.sock")
+        
+        # Call the method with the shim seeing a socket module without
+        # AF_UNIX; the real module other threads use is left alone
+        no_unix_socket = SimpleNamespace(**{name: value for name, value in vars(socket).items()
+                                            if name != "AF_UNIX"})
+        with mock.patch.object(usbip_to_gadget, "socket", no_unix_socket):
+            result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        self.socket_factory.assert_called_once_with(socket.AF_INET, socket.SOCK_STREAM)
+        self.mock_socket.connect.assert_called_once_with(("127.0.0.1", 3240))
+    
+    def test_main_unix_socket_default(self):
+        """Test that only the default port tries the local Unix socket"""
+        # Run main() as root outside Docker, with the shim mocked out
+        def run_main(*argv):
+            with mock.patch.object(usbip_to_gadget.sys, "argv", ["usbip_to_gadget.py", *argv]), \
+                 mock.patch.object(usbip_to_gadget, "USBIPShim") as shim_class, \
+                 mock.patch.object(usbip_to_gadget, "is_running_in_docker", return_value=False), \
+                 mock.patch.object(os, "geteuid", return_value=0):
+                self.assertEqual(usbip_to_gadget.main(), 0)
+            return shim_class.call_args
+        
+        # Verify
+        call = run_main()
+        self.assertEqual(call[0][1], USBIP_PORT)
+        self.assertEqual(call[1]["unix_socket"], usbip_to_gadget.USBIP_UNIX_SOCKET_PATH)
+        call = run_main("--port", "4000")
+        self.assertEqual(call[0][1], 4000)
+        self.assertIsNone(call[1]["unix_socket"])
+    
+    def test_connect_provided_socket(self):
+        """Test that a socket passed to the shim is used as the connection"""
+        # Set up the shim with an already connected socket
+        provided_socket = mock.MagicMock()
+        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename, sock=provided_socket,
+                              socket_factory=self.socket_factory)
+        
+        # Call the method
+        result = self.shim.connect()
+        
+        # Verify
+        self.assertTrue(result)
+        self.assertIs(self.shim.sock, provided_socket)
+        self.socket_factory.assert_not_called()
+        provided_socket.connect.assert_not_called()
+    
+    def test_cleanup(self):
+        """Test resource cleanup"""
+        # Setup
+        self.shim.sock = self.mock_socket
+        self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
+        self.shim.connected = True
+        
+        # Call the method
+        self.shim.cleanup()
+        
+        # Verify
+        self.assertFalse(self.shim.connected)
+        self.assertIsNone(self.shim.sock)
+        self.assertIsNone(self.shim.hid_fd)
+        self.mock_socket.close.assert_called_once()
+    
+    def test_forward_to_hid(self):
+        """Test forwarding data to HID device"""
+        # Setup
+        test_data = b"FIDO_TEST_DATA" + b"\x00" * 50  # Pad to make 64 bytes
+        expected_response = b"FIDO_RESPONSE" + b"\x00" * 52
+        
+        # Mock the os.write and os.read functions to simulate device I/O
+        original_write = os.write
+        original_read = os.read
+        
+        def mock_write(fd, data):
+            # Just record that write was called
+            self.assertEqual(fd, self.shim.hid_fd)
+            self.assertEqual(data, test_data)
+            return len(data)
+            
+        def mock_read(fd, length):
+            self.assertEqual(fd, self.shim.hid_fd)
+            self.assertEqual(length, USB_PACKET_SIZE)
+            return expected_response
+        
+        try:
+            # Replace the os functions with our mocks
+            os.write = mock_write
+            os.read = mock_read
+            
+            # Set up the shim
+            self.shim.connected = True
+            self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
+            
+            # Test the method
+            response = self.shim.forward_to_hid(test_data)
+            
+            # Verify that response contains our expected data
+            self.assertEqual(response, expected_response)
+        finally:
+            # Restore original os functions
+            os.write = original_write
+            os.read = original_read
+    
+    def test_process_usbip_messages(self):
+        """Test the message loop on 48 byte USB/IP commands"""
+        # Setup: the shim reads commands from one end of a socket pair
+        server_end, self.shim.sock = socket.socketpair()
+        self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
+        self.shim.connected = True
+        self.shim.device_attached = True
+        
+        # An OUT submit with its transfer buffer, an IN submit and an unlink;
+        # a submit carries the transfer buffer length at offset 24
+        payload = b"FIDO_TEST_DATA".ljust(USB_PACKET_SIZE, b"\x00")
+        messages = (
+            struct.pack("!IIIIIIIIII8x", USBIP_CMD_SUBMIT, 1, 0, USBIP_DIR_OUT, USB_ENDPOINT_OUT,
+                        0, len(payload), 0, 0, 0) + payload
+            + struct.pack("!IIIIIIIIII8x", USBIP_CMD_SUBMIT, 2, 0, USBIP_DIR_IN, USB_ENDPOINT_IN,
+                          0, USB_PACKET_SIZE, 0, 0, 0)
+            + struct.pack("!IIIIII24x", USBIP_CMD_UNLINK, 3, 0, 0, 0, 2)
+        )
+        server_end.sendall(messages)
+        server_end.shutdown(socket.SHUT_WR)
+        
+        # Call the method; it returns once it sees the end of the stream
+        with mock.patch.object(os, 'read', return_value=b"") as mock_read:
+            self.shim.process_usbip_messages()
+        
+        # Verify every command got its reply, in order
+        replies = server_end.recv(4096)
+        self.assertEqual(len(replies), 3 * _SUBMIT_REPLY.size)
+        self.assertEqual([_SUBMIT_REPLY.unpack_from(replies, offset)[:2]
+                          for offset in range(0, len(replies), _SUBMIT_REPLY.size)],
+                         [(3, 1), (3, 2), (4, 3)])
+        
+        # Verify only the OUT transfer buffer went to the HID device
+        mock_read.assert_called_once_with(self.shim.hid_fd, USB_PACKET_SIZE)
+        os.lseek(self.shim.hid_fd, 0, os.SEEK_SET)
+        self.assertEqual(os.read(self.shim.hid_fd, 2 * USB_PACKET_SIZE), payload)
+        
+        server_end.close()
+        self.shim.cleanup()
+    
+    def test_process_usbip_messages_sends_replies_before_hid(self):
+        """Test that queued replies are sent before waiting on the HID device"""
+        # Setup: the shim reads commands from one end of a socket pair
+        server_end, self.shim.sock = socket.socketpair()
+        self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
+        self.shim.connected = True
+        self.shim.device_attached = True
+        
+        # An IN submit, then an OUT submit that goes to the HID device,
+        # both read by the shim at once
+        payload = b"FIDO_TEST_DATA".ljust(USB_PACKET_SIZE, b"\x00")
+        server_end.sendall(
+            struct.pack("!IIIIIIIIII8x", USBIP_CMD_SUBMIT, 1, 0, USBIP_DIR_IN, USB_ENDPOINT_IN,
+                        0, USB_PACKET_SIZE, 0, 0, 0)
+            + struct.pack("!IIIIIIIIII8x", USBIP_CMD_SUBMIT, 2, 0, USBIP_DIR_OUT, USB_ENDPOINT_OUT,
+                          0, len(payload), 0, 0, 0) + payload
+        )
+        server_end.shutdown(socket.SHUT_WR)
+        
+        # The HID read stands in for the device answering; by then the
+        # reply to the first message must already be on its way
+        early_replies = []
+        
+        def mock_read(fd, length):
+            early_replies.append(server_end.recv(4096, socket.MSG_DONTWAIT))
+            return b""
+        
+        # Call the method
+        with mock.patch.object(os, 'read', side_effect=mock_read):
+            self.shim.process_usbip_messages()
+        
+        # Verify
+        self.assertEqual(len(early_replies), 1)
+        self.assertEqual(len(early_replies[0]), _SUBMIT_REPLY.size)
+        self.assertEqual(_SUBMIT_REPLY.unpack(early_replies[0])[:2], (3, 1))
+        self.assertEqual(_SUBMIT_REPLY.unpack(server_end.recv(4096))[:2], (3, 2))
+        
+        server_end.close()
+        self.shim.cleanup()
+    
+    def test_usage_matches_parser_help(self):
+        """Test that the pre-rendered help text matches the parser's"""
+        # Pin the width argparse wraps the help text to
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            help_text = _build_parser().format_help()
+        
+        # Verify
+        self.assertEqual(_USAGE, help_text)
+    
+    def test_handle_usb_message_submit_out(self):
+        """Test handling a USB SUBMIT command (OUT direction)"""
+        # Setup
+        header = dict(
+            command=USBIP_CMD_SUBMIT,
+            sequence_number=123,
+            direction=USBIP_DIR_OUT,
+            endpoint=USB_ENDPOINT_OUT,
+            actual_length=64
+        )
+        data = b"TEST_OUT_DATA" + b"\x00" * 52  # 64 bytes
+        
+        # Mock the forward_to_hid method
+        self.shim.forward_to_hid = mock.MagicMock(return_value=b"RESPONSE" + b"\x00" * 56)
+        
+        # Call the method
+        response, response_data = self.shim.handle_usb_message(**header, data=data)
+        
+        # Verify
+        self.shim.forward_to_hid.assert_called_once_with(data)
+        self.assertEqual(len(response), 24)  # Just header for OUT direction
+        self.assertEqual(response_data, b'')
+    
+    def test_handle_usb_message_submit_in(self):
+        """Test handling a USB SUBMIT command (IN direction)"""
+        # Setup
+        header = dict(
+            command=USBIP_CMD_SUBMIT,
+            sequence_number=124,
+            direction=USBIP_DIR_IN,
+            endpoint=USB_ENDPOINT_IN,
+            actual_length=0
+        )
+        
+        # Call the method
+        response, response_data = self.shim.handle_usb_message(**header)
+        
+        # Verify
+        self.assertEqual(len(response), 24)  # Header only for empty response
+        self.assertEqual(response_data, b'')
+    
+    def test_handle_usb_message_unlink(self):
+        """Test handling a USB UNLINK command"""
+        # Setup
+        header = dict(
+            command=USBIP_CMD_UNLINK,
+            sequence_number=125,
+            endpoint=0,
+            direction=0,
+            actual_length=0
+        )
+        
+        # Call the method
+        response, response_data = self.shim.handle_usb_message(**header)
+        
+        # Verify response format
+        self.assertEqual(len(response), 24)  # UNLINK response is 24 bytes
+        
+        # Check sequence number in response
+        seq_num = struct.unpack("!I", response[4:8])[0]
+        self.assertEqual(seq_num, 125)
+    
+    def test_handle_unknown_command(self):
+        """Test handling an unknown USB command"""
+        # Setup
+        header = dict(
+            command=0xFFFF,  # Unknown command
+            sequence_number=126,
+            endpoint=0,
+            direction=0,
+            actual_length=0
+        )
+        
+        # Call the method
+        response, response_data = self.shim.handle_usb_message(**header)
+        
+        # Verify
+        self.assertEqual(response, b'')  # Should return empty response
+        self.assertEqual(response_data, b'')
+
+
+class TestUSBIPHIDIntegrationFake(unittest.TestCase):
+    """Integration tests with fake server and device"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        # Create a fake HID device (temp file)
+        self.fake_hid = tempfile.NamedTemporaryFile(delete=False)
+        self.fake_hid_path = self.fake_hid.name
+        self.fake_hid.close()
+        
+        # Create a fake USBIP server on one end of a connected socket pair;
+        # no listener or port is needed
+        self.client_end, self.server_end = socket.socketpair()
+        
+        # Start server thread
+        self.server_thread = threading.Thread(target=self.fake_usbip_server)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        
+        # Create shim instance with fake device, connected to the server
+        self.shim = USBIPShim("127.0.0.1", USBIP_PORT, self.fake_hid_path, sock=self.client_end)
+    
+    def tearDown(self):
+        """Clean up test resources"""
+        # Stop server; it sees the shutdown as the client disconnecting
+        self.client_end.shutdown(socket.SHUT_RDWR)
+        self.server_thread.join(1)
+        self.client_end.close()
+        self.server_end.close()
+        
+        # Remove fake HID device
+        if os.path.exists(self.fake_hid_path):
+            os.unlink(self.fake_hid_path)
+    
+    def fake_usbip_server(self):
+        """Run a fake USBIP server for testing"""
+        try:
+            # The server end is already connected to the shim
+            client_sock = self.server_end
+            
+            # Simulate USBIP server responses
+            while True:
+                data = client_sock.recv(1024)
+                if not data:
+                    break
+                
+                # Fake response for device list
+                if len(data) >= 8 and _U32.unpack_from(data, 0)[0] == 0x01118005:
+                    # OP_REQ_DEVLIST
+                    response = _HHI.pack(0x0111, 0x0001, 0)  # Version, reply code, status
+                    response += _U32.pack(1)  # 1 device
+                    
+                    # Device information
+                    response += _DEVICE_SUMMARY.pack(
+                        b"", b"2-2", 2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1, 1, 1
+                    )
+                    response += _DEVICE_INTERFACE.pack(3, 0)  # HID interface
+                    
+                    client_sock.sendall(response)
+                
+                # Fake response for import device
+                elif len(data) >= 8 and _U32.unpack_from(data, 0)[0] == 0x01118003:
+                    # OP_REQ_IMPORT
+                    response = _HHI.pack(0x0111, 0x0003, 0)  # Version, reply code, status
+                    
+                    # Device information
+                    response += _DEVICE_SUMMARY.pack(
+                        b"", b"2-2", 2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1, 1, 1
+                    )
+                    
+                    client_sock.sendall(response)
+                
+                # Fake response for USB messages
+                elif len(data) >= 4:
+                    # Parse command
+                    cmd = _U32.unpack_from(data, 0)[0]
+                    
+                    if cmd == USBIP_CMD_SUBMIT:
+                        # Return a fake SUBMIT response
+                        seq_num = _U32.unpack_from(data, 4)[0]
+                        response = _SUBMIT_REPLY.pack(
+                            0x00000003,  # Reply to SUBMIT
+                            seq_num,
+                            0,  # Status
+                            0,  # Actual length
+                            0,  # Start frame
+                            0   # Error count
+                        )
+                        client_sock.sendall(response)
+                    
+                    elif cmd == USBIP_CMD_UNLINK:
+                        # Return a fake UNLINK response
+                        seq_num = _U32.unpack_from(data, 4)[0]
+                        response = _SUBMIT_REPLY.pack(
+                            0x00000004,  # Reply to UNLINK
+                            seq_num,
+                            0,  # Status
+                            0, 0, 0  # Padding
+                        )
+                        client_sock.sendall(response)
+        
+        except Exception as e:
+            print(f"Fake server error: {e}")
+        finally:
+            if 'client_sock' in locals():
+                client_sock.close()
+    
+    def test_connect_and_attach(self):
+        """Test connecting to server and attaching device"""
+        # Mock socket's recv method to return proper responses
+        self.shim.sock = mock.MagicMock()
+        
+        # Mock the connect method
+        self.shim.connect = mock.MagicMock(return_value=True)
+        
+        # For attach_device, create a mocked socket with proper responses
+        # First response: device list header
+        dev_list_header = struct.pack("!HHI", 0x0111, 0x0001, 0)  # Version, reply code, status
+        # Second response: number of devices
+        dev_count = struct.pack("!I", 1)  # 1 device
+        # Third response: device summary and its interface
+        device_summary = struct.pack("!256s32sIIIHHHBBBBBB",
+            b"", b"2-2", 2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1, 1, 1
+        )
+        dev_info = device_summary + struct.pack("!BBx", 3, 0)
+        
+        # Import response header
+        import_header = struct.pack("!HHI", 0x0111, 0x0003, 0)  # Version, reply code, status
+        # Import response data
+        import_data = device_summary
+        
+        # Configure socket.recv_into to deliver our prepared responses in
+        # sequence, split so the shim has to read some of them in pieces
+        chunks = [
+            dev_list_header, dev_count + dev_info[:100], dev_info[100:],
+            import_header + import_data[:10], import_data[10:]
+        ]
+        
+        def recv_into(view):
+            chunk = chunks.pop(0)
+            view[:len(chunk)] = chunk
+            return len(chunk)
+        
+        self.shim.sock.recv_into = mock.MagicMock(side_effect=recv_into)
+        
+        # Attach device
+        attach_result = self.shim.attach_device()
+        self.assertTrue(attach_result)
+        
+        # Verify state, and that exactly the responses were consumed
+        self.assertTrue(self.shim.device_attached)
+        self.assertEqual(chunks, [])
+        self.assertEqual(self.shim._rx_head, self.shim._rx_tail)
+
+
+class TestMockUSBIPServer(unittest.TestCase):
+    """Test cases for the mock USB/IP server used by the Docker tests"""
+    
+    def setUp(self):
+        """Start a mock server on a free port and connect to it"""
+        self.server = MockUSBIPServer(port=0)
+        self.assertTrue(self.server.start())
+        self.client = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+    
+    def tearDown(self):
+        """Clean up test resources"""
+        self.client.close()
+        self.server.cleanup()
+    
+    def recv_exactly(self, length):
+        """Read exactly length bytes of replies from the server"""
+        data = b""
+        while len(data) < length:
+            chunk = self.client.recv(length - len(data))
+            self.assertTrue(chunk, "server closed the connection")
+            data += chunk
+        return data
+    
+    def test_submit_seqnums_matching_op_codes(self):
+        """Test that submits numbered like the old OP codes stay submits"""
+        # Sequence numbers 1 and 3 used to be taken for OP requests
+        for seq_num in (1, 3):
+            self.client.sendall(struct.pack("!IIIIIIIIII8x", USBIP_CMD_SUBMIT, seq_num, 0,
+                                            USBIP_DIR_IN, USB_ENDPOINT_IN, 0, USB_PACKET_SIZE, 0, 0, 0))
+        
+        # Verify both got a RET_SUBMIT reply, in order
+        replies = self.recv_exactly(2 * _SUBMIT_REPLY.size)
+        self.assertEqual(_SUBMIT_REPLY.unpack_from(replies, 0)[:2], (3, 1))
+        self.assertEqual(_SUBMIT_REPLY.unpack_from(replies, _SUBMIT_REPLY.size)[:2], (3, 3))
+        
+        # Verify an OP request on the same stream still gets the device list
+        self.client.sendall(_HHI.pack(0x0111, 0x8005, 0))
+        version, command, status = _HHI.unpack(self.recv_exactly(_HHI.size))
+        self.assertEqual((version, status), (0x0111, 0))
+        self.assertEqual(_U32.unpack(self.recv_exactly(_U32.size))[0], 1)
+
+    
+    def test_cleanup_twice(self):
+        """Test that cleaning up stops the server loop once"""
+        # Call the method twice, as the test environment and loop both do
+        with self.assertLogs("docker_test_helper", "INFO") as logs:
+            self.server.cleanup()
+            self.server.cleanup()
+        
+        # Verify the loop stopped and cleanup only ran once
+        self.assertFalse(self.server.thread.is_alive())
+        self.assertEqual(logs.output.count("INFO:docker_test_helper:Mock USB/IP server cleaned up"), 1)
+        self.assertEqual(self.server.clients, {})
+
+
+class TestMockUSBIPServerUnixSocket(unittest.TestCase):
+    """Test cases for the mock USB/IP server on a Unix socket"""
+    
+    def setUp(self):
+        """Set up a socket path in a temporary directory"""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.socket_path = os.path.join(temp_dir.name, "mock_usbip.sock")
+    
+    def test_stale_unix_socket(self):
+        """Test that a Unix socket file left by an earlier run is replaced"""
+        # Setup: leave a socket file behind, as a crashed run would
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        
+        # Call the method
+        server = MockUSBIPServer(host=self.socket_path)
+        self.addCleanup(server.cleanup)
+        self.assertTrue(server.start())
+        
+        # Verify the server listens there and removes the file on cleanup
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        client.close()
+        server.cleanup()
+        self.assertFalse(os.path.exists(self.socket_path))
+    
+    def test_other_file_left_alone(self):
+        """Test that a file at the socket path that isn't a socket is kept"""
+        # Setup
+        with open(self.socket_path, "w") as f:
+            f.write("not a socket")
+        
+        # Call the method
+        server = MockUSBIPServer(host=self.socket_path)
+        self.addCleanup(server.cleanup)
+        with self.assertLogs("docker_test_helper", "ERROR"):
+            self.assertFalse(server.start())
+        
+        # Verify
+        with open(self.socket_path) as f:
+            self.assertEqual(f.read(), "not a socket")
+
+
+if __name__ == "__main__":
+    unittest.main()
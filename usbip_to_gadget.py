@@ -22,29 +22,41 @@ In Docker environment:
 
 import socket
 import struct
-import fcntl
 import os
 import time
-import threading
-import argparse
 import sys
-import logging
-import unittest
-import tempfile
-import io
-import binascii
-from unittest import mock
+import functools
+from types import SimpleNamespace
 from typing import Optional, Tuple, List, Dict
 
 # Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger('usbip_shim')
+class _LazyLogger:
+    """Stand-in for the shim's logger that imports logging on first use"""
+    
+    _logger = None
+    
+    def __getattr__(self, name):
+        # Only reached for logger methods; the first one configures logging
+        # and replaces this stand-in with the real logger
+        global logger
+        if _LazyLogger._logger is None:
+            import logging
+            logging.basicConfig(
+                level=logging.INFO,
+                format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            )
+            _LazyLogger._logger = logging.getLogger('usbip_shim')
+            logger = _LazyLogger._logger
+        return getattr(_LazyLogger._logger, name)
+
+logger = _LazyLogger()
+
+# Same value as logging.DEBUG, without importing logging to get it
+_LOG_DEBUG = 10
 
 # Constants
 USBIP_PORT = 3240
+USBIP_UNIX_SOCKET_PATH = '/var/run/usbipd.sock'
 HID_DEVICE_PATH = '/dev/hidg0'
 USB_PACKET_SIZE = 64
 
@@ -59,30 +71,100 @@ USB_ENDPOINT_CONTROL = 0
 USB_ENDPOINT_OUT = 1
 USB_ENDPOINT_IN = 2
 
+# Precompiled USB/IP wire formats
+_HDR = struct.Struct("!IIIII")  # Command, seqnum, devid, direction, ep
+_SUBMIT_REPLY = struct.Struct("!IIIIII")  # Also the size of unlink replies
+_U32 = struct.Struct("!I")
+_HHI = struct.Struct("!HHI")  # Version, reply code, status
+
+# CMD_SUBMIT and CMD_UNLINK are both 48 bytes: the 20 byte header, then for
+# a submit the transfer flags, transfer buffer length, start frame, number of
+# packets, interval and 8 byte setup packet (an unlink has the sequence
+# number to unlink and padding). OUT submits are followed by the transfer
+# buffer
+_CMD_SIZE = 48
+_TRANSFER_LENGTH_OFFSET = _HDR.size + 4
+
+# Device records as sent by usbip/usbip.go: every device in OP_REP_DEVLIST is
+# a summary (path, bus ID, bus/dev numbers, speed, IDs and class fields)
+# followed by one 3 byte interface record; OP_REP_IMPORT carries the summary
+_DEVICE_SUMMARY = struct.Struct("!256s32sIIIHHHBBBBBB")
+_DEVICE_INTERFACE = struct.Struct("!BBx")  # Class, subclass, padding
+_DEVLIST_ENTRY_LEN = _DEVICE_SUMMARY.size + _DEVICE_INTERFACE.size
+
+# Bound C implementations used directly by the message loop
+_parse_header = _HDR.unpack_from
+_parse_u32 = _U32.unpack_from
+
+# OP requests: protocol version, request code and status
+USBIP_VERSION = 0x0111
+_DEVLIST_REQUEST = _HHI.pack(USBIP_VERSION, 0x8005, 0)  # OP_REQ_DEVLIST
+
+# Virtual FIDO exposes a single device on bus ID "2-2"; its import request
+# (OP_REQ_IMPORT plus the bus ID padded to 32 bytes) never changes
+VIRTUAL_FIDO_BUS_ID = "2-2"
+_IMPORT_REQUEST = (
+    _HHI.pack(USBIP_VERSION, 0x8003, 0)  # OP_REQ_IMPORT
+    + VIRTUAL_FIDO_BUS_ID.encode('ascii').ljust(32, b'\0')
+)
+
 class USBIPShim:
     """Bridge between USB/IP and USB HID Gadget"""
     
-    def __init__(self, usbip_host: str, usbip_port: int, hid_device: str):
+    def __init__(self, usbip_host: str, usbip_port: int, hid_device: str,
+                 sock: Optional[socket.socket] = None,
+                 socket_factory=socket.socket, opener=os.open,
+                 unix_socket: Optional[str] = None, tcp_nodelay: bool = True):
         self.usbip_host = usbip_host
         self.usbip_port = usbip_port
+        # Unix socket of a local server, tried before TCP when set
+        self.unix_socket = unix_socket
+        # Disable Nagle's algorithm on TCP connections (on unless --nagle)
+        self.tcp_nodelay = tcp_nodelay
         self.hid_device = hid_device
-        self.sock = None
+        # How connect() creates the server socket and opens the HID device;
+        # tests pass their own instead of patching the socket and os modules
+        self._socket_factory = socket_factory
+        self._opener = opener
+        # An already connected socket, if given, is used instead of dialing
+        self.sock = sock
         self.hid_fd = None
         self.connected = False
+        # Only touched by the thread running process_usbip_messages(), so it
+        # needs no lock
         self.pending_requests: Dict[int, dict] = {}
-        self.lock = threading.Lock()
+        # Bytes received from the USB/IP server; messages are parsed in place
+        # from _rx_head, and _rx_tail is where the next recv_into writes
+        self._rxbuf = bytearray(65536)
+        self._rx_head = 0
+        self._rx_tail = 0
+        # Reply headers are packed here and returned by handle_usb_message()
+        self._reply_buf = bytearray(_SUBMIT_REPLY.size)
+        # Replies to the messages handled since the last recv; they are sent
+        # together just before the loop waits for more data
+        self._txbuf = bytearray()
         self.device_attached = False
     
     def connect(self) -> bool:
         """Connect to USB/IP server and open HID device"""
         try:
-            # Connect to USB/IP server
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.usbip_host, self.usbip_port))
-            logger.info(f"Connected to USB/IP server at {self.usbip_host}:{self.usbip_port}")
+            # Connect to USB/IP server; a host given as a path is a Unix socket
+            if self.sock is not None:
+                logger.info("Using the provided USB/IP server connection")
+            elif self.usbip_host.startswith('/'):
+                self.sock = self._socket_factory(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.usbip_host)
+                logger.info(f"Connected to USB/IP server at {self.usbip_host}")
+            elif self.unix_socket and self._connect_unix(self.unix_socket):
+                logger.info(f"Connected to USB/IP server at {self.unix_socket}")
+            else:
+                self.sock = self._socket_factory(socket.AF_INET, socket.SOCK_STREAM)
+                self._tune_tcp_socket()
+                self.sock.connect((self.usbip_host, self.usbip_port))
+                logger.info(f"Connected to USB/IP server at {self.usbip_host}:{self.usbip_port}")
             
             # Open HID device
-            self.hid_fd = os.open(self.hid_device, os.O_RDWR)
+            self.hid_fd = self._opener(self.hid_device, os.O_RDWR)
             logger.info(f"Opened HID device at {self.hid_device}")
             
             self.connected = True
@@ -92,6 +174,38 @@ class USBIPShim:
             self.cleanup()
             return False
     
+    def _connect_unix(self, path: str) -> bool:
+        """Try a local server's Unix socket; False if nothing listens there"""
+        if not hasattr(socket, "AF_UNIX"):
+            logger.debug(f"No Unix sockets on this platform, using TCP instead of {path}")
+            return False
+        sock = self._socket_factory(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError as e:
+            sock.close()
+            logger.debug(f"No USB/IP server on {path} ({e}), using TCP")
+            return False
+        self.sock = sock
+        return True
+    
+    def _tune_tcp_socket(self):
+        """Configure the TCP socket for small, latency-sensitive messages"""
+        # Replies are tiny, so send them immediately instead of letting
+        # Nagle's algorithm hold them back waiting for an ACK
+        if self.tcp_nodelay:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Room for a burst of messages, so one recv_into can drain them all;
+        # set before connecting so the window scale covers the larger buffer
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)
+        # Acknowledge right away rather than waiting to piggyback (Linux only)
+        if hasattr(socket, "TCP_QUICKACK"):
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            except OSError:
+                pass
+    
     def cleanup(self):
         """Close connections and clean up resources"""
         if self.sock:
@@ -109,49 +223,54 @@ class USBIPShim:
         """Attach the virtual USB device via USB/IP"""
         try:
             # Send OP_REQ_DEVLIST command
-            command_header = struct.pack("!II", 0x8005, 0x00000001)  # Version 1, OP_REQ_DEVLIST
-            self.sock.sendall(command_header)
+            self.sock.sendall(_DEVLIST_REQUEST)
             
-            # Read response header
-            header_data = self.sock.recv(8)
-            if not header_data or len(header_data) < 8:
+            # Read response header and number of devices
+            if not self._ensure(_HHI.size + _U32.size):
                 logger.error("Failed to read device list response header")
                 return False
             
             # Parse response to get device info
-            version, command, status = struct.unpack("!HHI", header_data)
-            
-            # Read number of devices
-            devices_data = self.sock.recv(4)
-            num_devices = struct.unpack("!I", devices_data)[0]
+            version, command, status = _HHI.unpack_from(self._rxbuf, self._rx_head)
+            num_devices = _U32.unpack_from(self._rxbuf, self._rx_head + _HHI.size)[0]
+            self._rx_head += _HHI.size + _U32.size
             logger.info(f"Found {num_devices} devices")
             
             if num_devices < 1:
                 logger.error("No devices available")
                 return False
             
-            # Read device information
-            device_data = self.sock.recv(1024)  # Read enough for the device info
+            # Read exactly the device information, so nothing is left behind
+            # to be mistaken for the import response
+            devices_length = num_devices * _DEVLIST_ENTRY_LEN
+            if not self._ensure(devices_length):
+                logger.error("Failed to read device list")
+                return False
+            self._rx_head += devices_length
             
             # Attach the first device (bus_id should be "2-2" for Virtual FIDO)
-            bus_id = "2-2"
+            bus_id = VIRTUAL_FIDO_BUS_ID
             
-            # Send OP_REQ_IMPORT command
-            command_header = struct.pack("!II", 0x8003, 0x00000003)  # Version 3, OP_REQ_IMPORT
-            self.sock.sendall(command_header)
-            
-            # Send bus_id (padded to 32 bytes)
-            padded_bus_id = bus_id.encode('ascii') + b'\0' * (32 - len(bus_id))
-            self.sock.sendall(padded_bus_id)
+            # Send OP_REQ_IMPORT command and padded bus_id in one write
+            self.sock.sendall(_IMPORT_REQUEST)
             
             # Read response header
-            import_header = self.sock.recv(8)
-            if not import_header or len(import_header) < 8:
+            if not self._ensure(_HHI.size):
                 logger.error("Failed to read import response header")
                 return False
+            version, command, status = _HHI.unpack_from(self._rxbuf, self._rx_head)
+            self._rx_head += _HHI.size
+            
+            # A failed import is just the header
+            if status != 0:
+                logger.error(f"Failed to import device {bus_id}: status {status}")
+                return False
             
             # Read device data
-            device_import_data = self.sock.recv(512)  # Large enough for the import data
+            if not self._ensure(_DEVICE_SUMMARY.size):
+                logger.error("Failed to read import response")
+                return False
+            self._rx_head += _DEVICE_SUMMARY.size
             
             logger.info(f"Device {bus_id} attached successfully")
             self.device_attached = True
@@ -167,67 +286,125 @@ class USBIPShim:
             logger.error("Not connected to HID device")
             return None
         
+        # The device may take a while to answer, so don't hold back replies
+        # to earlier messages while waiting on it
+        if self._txbuf:
+            self._send_replies()
+        
         try:
+            # Hex-dumping every packet is only worth it when debugging
+            debug = logger.isEnabledFor(_LOG_DEBUG)
+            
             os.write(self.hid_fd, data)
-            logger.debug(f"Wrote {len(data)} bytes to HID device: {data.hex()}")
+            if debug:
+                logger.debug(f"Wrote {len(data)} bytes to HID device: {data.hex()}")
             
             # Read response (may need adjustment based on protocol timing)
             response = os.read(self.hid_fd, USB_PACKET_SIZE)
-            logger.debug(f"Read {len(response)} bytes from HID device: {response.hex()}")
+            if debug:
+                logger.debug(f"Read {len(response)} bytes from HID device: {response.hex()}")
             return response
         except Exception as e:
             logger.error(f"HID communication error: {e}")
             return None
     
-    def handle_usb_message(self, header: dict, data: Optional[bytes] = None) -> bytes:
-        """Process a USB message and return the appropriate response"""
-        if header['command'] == USBIP_CMD_SUBMIT:
+    def handle_usb_message(self, command: int, sequence_number: int, direction: int, endpoint: int,
+                           actual_length: int = 0, data: Optional[bytes] = None) -> Tuple[bytes, bytes]:
+        """Process a USB message and return the response header and data
+        
+        The header is a reused buffer, valid until the next call. The data is
+        only non-empty for IN transfers and is sent straight after the header.
+        """
+        if command == USBIP_CMD_SUBMIT:
             # Handle SUBMIT command
             response_data = b''
             
             # If this is an OUT transaction with data
-            if header['direction'] == USBIP_DIR_OUT and data:
+            if direction == USBIP_DIR_OUT and data:
                 # For endpoint 1 (OUT), forward to HID and get response
-                if header['endpoint'] == USB_ENDPOINT_OUT:
+                if endpoint == USB_ENDPOINT_OUT:
                     hid_response = self.forward_to_hid(data)
                     if hid_response:
                         response_data = hid_response
                 
                 # For control endpoint, process setup packet
-                elif header['endpoint'] == USB_ENDPOINT_CONTROL:
+                elif endpoint == USB_ENDPOINT_CONTROL:
                     # Just acknowledge for now
                     pass
             
             # Create response header
-            response_header = struct.pack(
-                "!IIIIII",
+            _SUBMIT_REPLY.pack_into(
+                self._reply_buf, 0,
                 0x00000003,  # Reply to SUBMIT
-                header['sequence_number'],
+                sequence_number,
                 0,  # Status
-                header['actual_length'],
+                actual_length,
                 0,  # Start frame
                 0   # Error count
             )
             
             # For IN transactions, include the response data
-            if header['direction'] == USBIP_DIR_IN:
-                return response_header + response_data
+            if direction == USBIP_DIR_IN:
+                return self._reply_buf, response_data
             else:
-                return response_header
+                return self._reply_buf, b''
         
-        elif header['command'] == USBIP_CMD_UNLINK:
+        elif command == USBIP_CMD_UNLINK:
             # Handle UNLINK command
-            return struct.pack(
-                "!IIIIII",
+            _SUBMIT_REPLY.pack_into(
+                self._reply_buf, 0,
                 0x00000004,  # Reply to UNLINK
-                header['sequence_number'],
+                sequence_number,
                 0,  # Status
                 0, 0, 0  # Padding
             )
+            return self._reply_buf, b''
         
         else:
-            logger.warning(f"Unknown command: {header['command']}")
-            return b''
+            logger.warning(f"Unknown command: {command}")
+            return b'', b''
+    
+    def _ensure(self, length: int) -> bool:
+        """Buffer at least length unparsed bytes; False if the server closed"""
+        head, tail = self._rx_head, self._rx_tail
+        if tail - head >= length:
+            return True
+        
+        buf = self._rxbuf
+        if head + length > len(buf):
+            # Not enough room after the head; move the unparsed bytes to the
+            # front, growing the buffer for a transfer larger than it
+            held = tail - head
+            with memoryview(buf) as view:
+                view[:held] = view[head:tail]
+            head, tail = 0, held
+            if length > len(buf):
+                buf.extend(bytes(length - len(buf)))
+        
+        # About to wait on the server, so send the replies queued so far
+        if self._txbuf:
+            self._send_replies()
+        
+        # One recv_into can pull in many queued messages at once
+        with memoryview(buf) as view:
+            while tail - head < length:
+                received = self.sock.recv_into(view[tail:])
+                if not received:
+                    break
+                tail += received
+        
+        self._rx_head, self._rx_tail = head, tail
+        return tail - head >= length
+    
+    def _send_replies(self, *parts: bytes):
+        """Send the queued replies followed by parts in one gathering write"""
+        buffers = [self._txbuf, *parts]
+        sent = self.sock.sendmsg(buffers)
+        total = sum(map(len, buffers))
+        if sent < total:
+            # The socket buffer filled up; send the rest the simple way
+            self.sock.sendall(b"".join(buffers)[sent:])
+        self._txbuf.clear()
     
     def process_usbip_messages(self):
         """Main loop to process USB/IP messages"""
@@ -235,54 +412,73 @@ class USBIPShim:
             logger.error("Not connected or device not attached")
             return
         
-        while self.connected:
-            try:
-                # Read message header (20 bytes for USB/IP protocol)
-                header_data = self.sock.recv(20)
-                if not header_data or len(header_data) < 20:
-                    if not header_data:
+        # Bind everything the loop uses per message to locals up front
+        ensure = self._ensure
+        parse_header = _parse_header
+        parse_u32 = _parse_u32
+        handle = self.handle_usb_message
+        rxbuf = self._rxbuf  # Grows in place, so this stays the same object
+        txbuf = self._txbuf
+        send_replies = self._send_replies
+        debug = logger.isEnabledFor(_LOG_DEBUG)
+        
+        try:
+            while self.connected:
+                # Read the whole command (48 bytes for USB/IP protocol)
+                if not ensure(_CMD_SIZE):
+                    if self._rx_tail == self._rx_head:
                         logger.info("Connection closed by server")
                     else:
-                        logger.error(f"Incomplete header received: {len(header_data)} bytes")
+                        logger.error(f"Incomplete header received: {self._rx_tail - self._rx_head} bytes")
                     break
                 
                 # Parse header
-                command, sequence_num, unused1, unused2, direction, endpoint = struct.unpack("!IIIIII", header_data[:24])
+                head = self._rx_head
+                command, sequence_num, devid, direction, endpoint = parse_header(rxbuf, head)
+                transfer_length = parse_u32(rxbuf, head + _TRANSFER_LENGTH_OFFSET)[0]
+                head += _CMD_SIZE
+                self._rx_head = head
                 
-                header = {
-                    'command': command,
-                    'sequence_number': sequence_num,
-                    'direction': direction,
-                    'endpoint': endpoint,
-                    'actual_length': 0
-                }
-                
-                logger.debug(f"Received USB/IP message: cmd={command}, seq={sequence_num}, dir={direction}, ep={endpoint}")
+                if debug:
+                    logger.debug(f"Received USB/IP message: cmd={command}, seq={sequence_num}, dir={direction}, ep={endpoint}")
                 
                 # Read additional data if needed
                 data = None
-                if command == USBIP_CMD_SUBMIT:
-                    # Read setup packet for control transfers
-                    setup_data = self.sock.recv(8)
-                    
-                    # Read transfer buffer for OUT transfers
-                    if direction == USBIP_DIR_OUT:
-                        buffer_length_data = self.sock.recv(4)
-                        buffer_length = struct.unpack("!I", buffer_length_data)[0]
-                        if buffer_length > 0:
-                            data = self.sock.recv(buffer_length)
-                            header['actual_length'] = len(data)
+                actual_length = 0
+                # Read transfer buffer for OUT transfers
+                if command == USBIP_CMD_SUBMIT and direction == USBIP_DIR_OUT and transfer_length > 0:
+                    if not ensure(transfer_length):
+                        logger.error("Incomplete transfer buffer received")
+                        break
+                    # The transfer buffer is used straight from the receive
+                    # buffer, so release it before reading on
+                    head = self._rx_head
+                    data = memoryview(rxbuf)[head:head + transfer_length]
+                    self._rx_head = head + transfer_length
+                    actual_length = transfer_length
                 
                 # Process the message
-                response = self.handle_usb_message(header, data)
+                try:
+                    response_header, response_data = handle(command, sequence_num, direction, endpoint, actual_length, data)
+                finally:
+                    if data is not None:
+                        data.release()
                 
-                # Send response back to USB/IP server
-                if response:
-                    self.sock.sendall(response)
-            
-            except Exception as e:
-                logger.error(f"Error processing USB/IP message: {e}")
-                break
+                if not response_header:
+                    continue
+                if self._rx_tail > self._rx_head:
+                    # More messages are waiting; queue the response to go
+                    # out with theirs
+                    txbuf += response_header
+                    txbuf += response_data
+                else:
+                    # Last message of the burst: send everything queued plus
+                    # this header and data in one sendmsg, without joining
+                    # them first
+                    send_replies(response_header, response_data)
+        
+        except Exception as e:
+            logger.error(f"Error processing USB/IP message: {e}")
         
         logger.info("Stopped processing USB/IP messages")
     
@@ -337,6 +533,7 @@ def test_hid_device(device_path: str):
         # In Docker, we can use a temporary file as a mock device
         if in_docker and device_path == HID_DEVICE_PATH:
             try:
+                import tempfile
                 logger.info("Creating a temporary mock HID device for Docker testing")
                 temp_file = tempfile.NamedTemporaryFile(delete=False)
                 temp_path = temp_file.name
@@ -375,330 +572,6 @@ def run_tests(args):
         return False
 
 
-# =============== Test Cases ===============
-
-class TestUSBIPShim(unittest.TestCase):
-    """Test cases for the USB/IP Shim"""
-    
-    def setUp(self):
-        """Set up test environment"""
-        # Create a temporary file to mock the HID device
-        self.temp_file = tempfile.NamedTemporaryFile(delete=False)
-        self.temp_filename = self.temp_file.name
-        self.temp_file.close()
-        
-        # Create mocked socket
-        self.mock_socket = mock.MagicMock()
-        socket.socket = mock.MagicMock(return_value=self.mock_socket)
-        
-        # Set up the shim with our test file as the HID device
-        self.shim = USBIPShim("127.0.0.1", 3240, self.temp_filename)
-    
-    def tearDown(self):
-        """Clean up after tests"""
-        # Remove temporary file
-        if os.path.exists(self.temp_filename):
-            os.unlink(self.temp_filename)
-    
-    def test_connect(self):
-        """Test connection setup"""
-        # Prepare mocks
-        self.mock_socket.connect = mock.MagicMock()
-        
-        # Call the method
-        result = self.shim.connect()
-        
-        # Verify
-        self.assertTrue(result)
-        self.assertTrue(self.shim.connected)
-        self.mock_socket.connect.assert_called_once_with(("127.0.0.1", 3240))
-    
-    def test_cleanup(self):
-        """Test resource cleanup"""
-        # Setup
-        self.shim.sock = self.mock_socket
-        self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
-        self.shim.connected = True
-        
-        # Call the method
-        self.shim.cleanup()
-        
-        # Verify
-        self.assertFalse(self.shim.connected)
-        self.assertIsNone(self.shim.sock)
-        self.assertIsNone(self.shim.hid_fd)
-        self.mock_socket.close.assert_called_once()
-    
-    def test_forward_to_hid(self):
-        """Test forwarding data to HID device"""
-        # Setup
-        test_data = b"FIDO_TEST_DATA" + b"\x00" * 50  # Pad to make 64 bytes
-        expected_response = b"FIDO_RESPONSE" + b"\x00" * 52
-        
-        # Mock the os.write and os.read functions to simulate device I/O
-        original_write = os.write
-        original_read = os.read
-        
-        def mock_write(fd, data):
-            # Just record that write was called
-            self.assertEqual(fd, self.shim.hid_fd)
-            self.assertEqual(data, test_data)
-            return len(data)
-            
-        def mock_read(fd, length):
-            self.assertEqual(fd, self.shim.hid_fd)
-            self.assertEqual(length, USB_PACKET_SIZE)
-            return expected_response
-        
-        try:
-            # Replace the os functions with our mocks
-            os.write = mock_write
-            os.read = mock_read
-            
-            # Set up the shim
-            self.shim.connected = True
-            self.shim.hid_fd = os.open(self.temp_filename, os.O_RDWR)
-            
-            # Test the method
-            response = self.shim.forward_to_hid(test_data)
-            
-            # Verify that response contains our expected data
-            self.assertEqual(response, expected_response)
-        finally:
-            # Restore original os functions
-            os.write = original_write
-            os.read = original_read
-    
-    def test_handle_usb_message_submit_out(self):
-        """Test handling a USB SUBMIT command (OUT direction)"""
-        # Setup
-        header = {
-            'command': USBIP_CMD_SUBMIT,
-            'sequence_number': 123,
-            'direction': USBIP_DIR_OUT,
-            'endpoint': USB_ENDPOINT_OUT,
-            'actual_length': 64
-        }
-        data = b"TEST_OUT_DATA" + b"\x00" * 52  # 64 bytes
-        
-        # Mock the forward_to_hid method
-        self.shim.forward_to_hid = mock.MagicMock(return_value=b"RESPONSE" + b"\x00" * 56)
-        
-        # Call the method
-        response = self.shim.handle_usb_message(header, data)
-        
-        # Verify
-        self.shim.forward_to_hid.assert_called_once_with(data)
-        self.assertEqual(len(response), 24)  # Just header for OUT direction
-    
-    def test_handle_usb_message_submit_in(self):
-        """Test handling a USB SUBMIT command (IN direction)"""
-        # Setup
-        header = {
-            'command': USBIP_CMD_SUBMIT,
-            'sequence_number': 124,
-            'direction': USBIP_DIR_IN,
-            'endpoint': USB_ENDPOINT_IN,
-            'actual_length': 0
-        }
-        
-        # Call the method
-        response = self.shim.handle_usb_message(header)
-        
-        # Verify
-        self.assertEqual(len(response), 24)  # Header only for empty response
-    
-    def test_handle_usb_message_unlink(self):
-        """Test handling a USB UNLINK command"""
-        # Setup
-        header = {
-            'command': USBIP_CMD_UNLINK,
-            'sequence_number': 125,
-            'endpoint': 0,
-            'direction': 0,
-            'actual_length': 0
-        }
-        
-        # Call the method
-        response = self.shim.handle_usb_message(header)
-        
-        # Verify response format
-        self.assertEqual(len(response), 24)  # UNLINK response is 24 bytes
-        
-        # Check sequence number in response
-        seq_num = struct.unpack("!I", response[4:8])[0]
-        self.assertEqual(seq_num, 125)
-    
-    def test_handle_unknown_command(self):
-        """Test handling an unknown USB command"""
-        # Setup
-        header = {
-            'command': 0xFFFF,  # Unknown command
-            'sequence_number': 126,
-            'endpoint': 0,
-            'direction': 0,
-            'actual_length': 0
-        }
-        
-        # Call the method
-        response = self.shim.handle_usb_message(header)
-        
-        # Verify
-        self.assertEqual(response, b'')  # Should return empty response
-
-
-class TestUSBIPHIDIntegrationFake(unittest.TestCase):
-    """Integration tests with fake server and device"""
-    
-    def setUp(self):
-        """Set up test environment"""
-        # Create a fake HID device (temp file)
-        self.fake_hid = tempfile.NamedTemporaryFile(delete=False)
-        self.fake_hid_path = self.fake_hid.name
-        self.fake_hid.close()
-        
-        # Create a fake USBIP server
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('127.0.0.1', 0))  # Bind to a random port
-        self.server_port = self.server_socket.getsockname()[1]
-        self.server_socket.listen(1)
-        
-        # Save original socket class
-        self.original_socket = socket.socket
-        
-        # Start server thread
-        self.server_thread = threading.Thread(target=self.fake_usbip_server)
-        self.server_thread.daemon = True
-        self.server_thread.start()
-        
-        # Create shim instance with fake device and server
-        self.shim = USBIPShim("127.0.0.1", self.server_port, self.fake_hid_path)
-    
-    def tearDown(self):
-        """Clean up test resources"""
-        # Stop server
-        if hasattr(self, 'server_socket'):
-            self.server_socket.close()
-        
-        # Restore original socket
-        socket.socket = self.original_socket
-        
-        # Remove fake HID device
-        if os.path.exists(self.fake_hid_path):
-            os.unlink(self.fake_hid_path)
-    
-    def fake_usbip_server(self):
-        """Run a fake USBIP server for testing"""
-        try:
-            # Accept connection
-            client_sock, addr = self.server_socket.accept()
-            
-            # Simulate USBIP server responses
-            while True:
-                data = client_sock.recv(1024)
-                if not data:
-                    break
-                
-                # Fake response for device list
-                if len(data) >= 8 and struct.unpack("!I", data[4:8])[0] == 0x00000001:
-                    # OP_REQ_DEVLIST
-                    response = struct.pack("!HHI", 0x0111, 0x0001, 0)  # Version, reply code, status
-                    response += struct.pack("!I", 1)  # 1 device
-                    
-                    # Device information (simplified)
-                    dev_info = b"2-2\0" + b"\0" * 28  # Bus ID
-                    dev_info += struct.pack("!IIIIIHHHBB", 
-                        2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1
-                    )
-                    response += dev_info
-                    
-                    client_sock.sendall(response)
-                
-                # Fake response for import device
-                elif len(data) >= 8 and struct.unpack("!I", data[4:8])[0] == 0x00000003:
-                    # OP_REQ_IMPORT
-                    response = struct.pack("!HHI", 0x0111, 0x0003, 0)  # Version, reply code, status
-                    
-                    # Basic device info
-                    dev_info = struct.pack("!II", 0x18d1, 0x5022)  # VendorID, ProductID
-                    response += dev_info + b"\0" * 500  # Padding
-                    
-                    client_sock.sendall(response)
-                
-                # Fake response for USB messages
-                elif len(data) >= 4:
-                    # Parse command
-                    cmd = struct.unpack("!I", data[0:4])[0]
-                    
-                    if cmd == USBIP_CMD_SUBMIT:
-                        # Return a fake SUBMIT response
-                        seq_num = struct.unpack("!I", data[4:8])[0]
-                        response = struct.pack("!IIIIII",
-                            0x00000003,  # Reply to SUBMIT
-                            seq_num,
-                            0,  # Status
-                            0,  # Actual length
-                            0,  # Start frame
-                            0   # Error count
-                        )
-                        client_sock.sendall(response)
-                    
-                    elif cmd == USBIP_CMD_UNLINK:
-                        # Return a fake UNLINK response
-                        seq_num = struct.unpack("!I", data[4:8])[0]
-                        response = struct.pack("!IIIIII",
-                            0x00000004,  # Reply to UNLINK
-                            seq_num,
-                            0,  # Status
-                            0, 0, 0  # Padding
-                        )
-                        client_sock.sendall(response)
-        
-        except Exception as e:
-            print(f"Fake server error: {e}")
-        finally:
-            if 'client_sock' in locals():
-                client_sock.close()
-    
-    def test_connect_and_attach(self):
-        """Test connecting to server and attaching device"""
-        # Mock socket's recv method to return proper responses
-        self.shim.sock = mock.MagicMock()
-        
-        # Mock the connect method
-        self.shim.connect = mock.MagicMock(return_value=True)
-        
-        # For attach_device, create a mocked socket with proper responses
-        # First response: device list header
-        dev_list_header = struct.pack("!HHI", 0x0111, 0x0001, 0)  # Version, reply code, status
-        # Second response: number of devices
-        dev_count = struct.pack("!I", 1)  # 1 device
-        # Third response: device info (simplified)
-        dev_info = b"2-2\0" + b"\0" * 28  # Bus ID
-        dev_info += struct.pack("!IIIIIHHHBB", 
-            2, 2, 2, 0x18d1, 0x5022, 0x0200, 0, 0, 0, 1
-        )
-        
-        # Import response header
-        import_header = struct.pack("!HHI", 0x0111, 0x0003, 0)  # Version, reply code, status
-        # Import response data
-        import_data = struct.pack("!II", 0x18d1, 0x5022)  # VendorID, ProductID
-        import_data += b"\0" * 500  # Padding
-        
-        # Configure socket.recv to return our prepared responses in sequence
-        self.shim.sock.recv = mock.MagicMock(side_effect=[
-            dev_list_header, dev_count, dev_info,
-            import_header, import_data
-        ])
-        
-        # Attach device
-        attach_result = self.shim.attach_device()
-        self.assertTrue(attach_result)
-        
-        # Verify state
-        self.assertTrue(self.shim.device_attached)
-
-
 class FunctionalTests:
     """Functional tests that can be run on a real system"""
     
@@ -759,8 +632,7 @@ class FunctionalTests:
             sock.connect(("127.0.0.1", USBIP_PORT))
             
             # Send a device list request
-            command_header = struct.pack("!II", 0x8005, 0x00000001)  # Version 1, OP_REQ_DEVLIST
-            sock.sendall(command_header)
+            sock.sendall(_DEVLIST_REQUEST)
             
             # Read response header
             header_data = sock.recv(8)
@@ -770,11 +642,11 @@ class FunctionalTests:
                 return False
             
             # Parse response
-            version, command, status = struct.unpack("!HHI", header_data)
+            version, command, status = _HHI.unpack(header_data)
             
             # Read number of devices
             devices_data = sock.recv(4)
-            num_devices = struct.unpack("!I", devices_data)[0]
+            num_devices = _U32.unpack(devices_data)[0]
             
             logger.info(f"Virtual FIDO server returned {num_devices} devices")
             logger.info("Virtual FIDO connectivity test successful")
@@ -811,30 +683,197 @@ class FunctionalTests:
         return all(results.values())
 
 
+@functools.lru_cache(maxsize=1)
 def is_running_in_docker():
-    """Check if running inside a Docker container"""
+    """Check if running inside a Docker container (detected once per process)"""
     try:
-        with open('/proc/1/cgroup', 'r') as f:
-            return any('docker' in line for line in f)
+        # One read and a bytes search instead of decoding and scanning lines
+        with open('/proc/1/cgroup', 'rb') as f:
+            return b'docker' in f.read()
     except:
         return False
 
-def main():
-    """Main entry point"""
-    parser = argparse.ArgumentParser(description="USB/IP to USB Gadget Shim for Virtual FIDO")
-    parser.add_argument("--host", default="127.0.0.1", help="USB/IP server host (default: 127.0.0.1)")
-    parser.add_argument("--port", type=int, default=USBIP_PORT, help=f"USB/IP server port (default: {USBIP_PORT})")
+def _create_mock_hid_device() -> Tuple[str, Optional[int]]:
+    """Create a stand-in HID device file for Docker
+    
+    Returns the path to open and, for an in-memory file, the descriptor that
+    keeps it alive; otherwise the path is a temporary file to unlink.
+    """
+    if hasattr(os, "memfd_create"):
+        # An anonymous in-memory file never touches the disk and is freed
+        # when the process exits, even if the shim dies before cleaning up
+        fd = os.memfd_create("vfido-hid", os.MFD_CLOEXEC)
+        return f"/proc/self/fd/{fd}", fd
+    
+    import tempfile
+    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    temp_file.close()
+    return temp_file.name, None
+
+
+def _build_parser():
+    """Build the full command line parser"""
+    import argparse
+    
+    # A fixed prog keeps the help text the same as _USAGE however the
+    # script is started
+    parser = argparse.ArgumentParser(prog="usbip_to_gadget.py",
+                                     description="USB/IP to USB Gadget Shim for Virtual FIDO")
+    parser.add_argument("--host", default="127.0.0.1", help="USB/IP server host, or a Unix socket path (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, help=f"USB/IP server port (default: {USBIP_PORT})")
+    parser.add_argument("--unix-socket", metavar="PATH", help=f"Unix socket of a local USB/IP server, tried before TCP (default: {USBIP_UNIX_SOCKET_PATH} when --host is loopback and --port is not given)")
+    parser.add_argument("--nagle", action="store_true", help="Leave Nagle's algorithm on for the TCP connection (default: off)")
     parser.add_argument("--hid-device", default=HID_DEVICE_PATH, help=f"HID device path (default: {HID_DEVICE_PATH})")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
     parser.add_argument("--test", action="store_true", help="Run basic connectivity tests and exit")
     parser.add_argument("--unittest", action="store_true", help="Run unit tests and exit")
     parser.add_argument("--functional-test", action="store_true", help="Run functional tests and exit")
     parser.add_argument("--docker-mode", action="store_true", help="Enable Docker-specific behaviors")
+    return parser
+
+
+# Pre-rendered -h/--help text, so asking for help doesn't build the argparse
+# parser and its formatter; it is _build_parser().format_help() at 80 columns,
+# which the unit tests check, so update both together. argparse titles the
+# options section "options:" from Python 3.10 and "optional arguments:" before
+_OPTIONS_HEADING = "options:" if sys.version_info >= (3, 10) else "optional arguments:"
+_USAGE = f"""\
+usage: usbip_to_gadget.py [-h] [--host HOST] [--port PORT]
+                          [--unix-socket PATH] [--nagle]
+                          [--hid-device HID_DEVICE] [--debug] [--test]
+                          [--unittest] [--functional-test] [--docker-mode]
+
+USB/IP to USB Gadget Shim for Virtual FIDO
+
+{_OPTIONS_HEADING}
+  -h, --help            show this help message and exit
+  --host HOST           USB/IP server host, or a Unix socket path (default:
+                        127.0.0.1)
+  --port PORT           USB/IP server port (default: {USBIP_PORT})
+  --unix-socket PATH    Unix socket of a local USB/IP server, tried before TCP
+                        (default: {USBIP_UNIX_SOCKET_PATH} when --host is loopback
+                        and --port is not given)
+  --nagle               Leave Nagle's algorithm on for the TCP connection
+                        (default: off)
+  --hid-device HID_DEVICE
+                        HID device path (default: {HID_DEVICE_PATH})
+  --debug               Enable debug logging
+  --test                Run basic connectivity tests and exit
+  --unittest            Run unit tests and exit
+  --functional-test     Run functional tests and exit
+  --docker-mode         Enable Docker-specific behaviors
+"""
+
+# Command line options understood by _parse_argv(): flags map to the
+# attribute they set, options with a value to the attribute and its type
+_FLAG_OPTIONS = {
+    "--nagle": "nagle",
+    "--debug": "debug",
+    "--test": "test",
+    "--unittest": "unittest",
+    "--functional-test": "functional_test",
+    "--docker-mode": "docker_mode",
+}
+_VALUE_OPTIONS = {
+    "--host": ("host", str),
+    "--port": ("port", int),
+    "--unix-socket": ("unix_socket", str),
+    "--hid-device": ("hid_device", str),
+}
+
+def _parse_argv(argv: List[str]) -> SimpleNamespace:
+    """Parse the command line in one pass over argv
+    
+    -h/--help prints the pre-rendered _USAGE and exits. Abbreviated
+    options and mistakes are handed to the argparse parser, so they get its
+    usual error messages.
+    """
+    args = SimpleNamespace(host="127.0.0.1", port=None, unix_socket=None,
+                           hid_device=HID_DEVICE_PATH)
+    for attr in _FLAG_OPTIONS.values():
+        setattr(args, attr, False)
+    
+    i = 0
+    try:
+        while i < len(argv):
+            token = argv[i]
+            i += 1
+            if token == "-h" or token == "--help":
+                sys.stdout.write(_USAGE)
+                sys.exit(0)
+            flag = _FLAG_OPTIONS.get(token)
+            if flag:
+                setattr(args, flag, True)
+                continue
+            
+            # --name=value or --name value
+            name, sep, value = token.partition("=")
+            attr, convert = _VALUE_OPTIONS[name]
+            if not sep:
+                value = argv[i]
+                i += 1
+                if value.startswith("-"):
+                    raise ValueError(f"{name} is missing its value")
+            setattr(args, attr, convert(value))
+    except (KeyError, IndexError, ValueError):
+        return _build_parser().parse_args(argv)
+    
+    return args
+
+
+def _run_unittests() -> int:
+    """Run the unit tests and return the exit code"""
+    # The tests live in their own module so that normal runs don't pay
+    # for importing unittest and the test classes
+    import unittest
+    try:
+        from test_usbip_to_gadget import (
+            TestUSBIPShim, TestUSBIPHIDIntegrationFake, TestMockUSBIPServer,
+            TestMockUSBIPServerUnixSocket
+        )
+    except ImportError as e:
+        logger.error(f"Cannot load the unit tests ({e}); --unittest needs "
+                     f"test_usbip_to_gadget.py and docker_test_helper.py next to usbip_to_gadget.py")
+        return 1
     
-    args = parser.parse_args()
+    test_loader = unittest.TestLoader()
+    test_suite = test_loader.loadTestsFromTestCase(TestUSBIPShim)
+    test_suite.addTests(test_loader.loadTestsFromTestCase(TestUSBIPHIDIntegrationFake))
+    test_suite.addTests(test_loader.loadTestsFromTestCase(TestMockUSBIPServer))
+    test_suite.addTests(test_loader.loadTestsFromTestCase(TestMockUSBIPServerUnixSocket))
+    
+    test_runner = unittest.TextTestRunner(verbosity=2)
+    result = test_runner.run(test_suite)
+    
+    return 0 if result.wasSuccessful() else 1
+
+
+# Hosts for which the shim first tries the local Unix socket
+_LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+def main():
+    """Main entry point"""
+    args = _parse_argv(sys.argv[1:])
+    
+    # --port is left unset when not given, so the Unix socket default below
+    # can tell an explicit port from the default one
+    port_given = args.port is not None
+    if not port_given:
+        args.port = USBIP_PORT
     
     if args.debug:
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(_LOG_DEBUG)
+    
+    # Run unit tests if requested; they need neither root nor Docker
+    # detection, so return before probing for either
+    if args.unittest:
+        return _run_unittests()
+    
+    # Run functional tests if requested; they use the real HID device path,
+    # and opening it reports missing permissions itself
+    if args.functional_test:
+        success = FunctionalTests.run_all_functional_tests()
+        return 0 if success else 1
     
     # Auto-detect Docker environment if not explicitly specified
     in_docker = args.docker_mode or is_running_in_docker()
@@ -842,47 +881,41 @@ def main():
         logger.info("Running in Docker environment")
     
     # Check if running as root for most operations
-    # Skip check in Docker or for unit tests
-    if not (args.unittest or in_docker) and os.geteuid() != 0:
+    # Skip check in Docker
+    if not in_docker and os.geteuid() != 0:
         logger.error("This script must be run as root (sudo)")
         return 1
     
-    # Run unit tests if requested
-    if args.unittest:
-        test_loader = unittest.TestLoader()
-        test_suite = test_loader.loadTestsFromTestCase(TestUSBIPShim)
-        test_suite.addTests(test_loader.loadTestsFromTestCase(TestUSBIPHIDIntegrationFake))
-        
-        test_runner = unittest.TextTestRunner(verbosity=2)
-        result = test_runner.run(test_suite)
-        
-        return 0 if result.wasSuccessful() else 1
-    
     # For Docker environment, modify paths and behavior as needed
+    mock_hid_fd = None
     if in_docker:
-        # Use a temp file as mock HID device in Docker
+        # Use a stand-in file as mock HID device in Docker
         if args.hid_device == HID_DEVICE_PATH:
-            temp_file = tempfile.NamedTemporaryFile(delete=False)
-            args.hid_device = temp_file.name
-            temp_file.close()
+            args.hid_device, mock_hid_fd = _create_mock_hid_device()
             logger.info(f"In Docker: Using temporary file as HID device: {args.hid_device}")
     
-    # Run functional tests if requested
-    if args.functional_test:
-        success = FunctionalTests.run_all_functional_tests()
-        return 0 if success else 1
-    
     # Run basic tests if requested
     if args.test:
         success = run_tests(args)
         return 0 if success else 1
     
+    # A server on this machine may also listen on a Unix socket, which
+    # skips the TCP/IP stack for every message (where Unix sockets exist);
+    # an explicit --port means that server, so don't go looking elsewhere
+    unix_socket = args.unix_socket
+    if (unix_socket is None and not port_given and args.host in _LOOPBACK_HOSTS
+            and hasattr(socket, "AF_UNIX")):
+        unix_socket = USBIP_UNIX_SOCKET_PATH
+    
     # Create and run the shim
-    shim = USBIPShim(args.host, args.port, args.hid_device)
+    shim = USBIPShim(args.host, args.port, args.hid_device, unix_socket=unix_socket,
+                     tcp_nodelay=not args.nagle)
     success = shim.run()
     
-    # Clean up temp file if created in Docker mode
-    if in_docker and args.hid_device != HID_DEVICE_PATH:
+    # Clean up the mock HID device if created in Docker mode
+    if mock_hid_fd is not None:
+        os.close(mock_hid_fd)
+    elif in_docker and args.hid_device != HID_DEVICE_PATH:
         try:
             os.unlink(args.hid_device)
         except: